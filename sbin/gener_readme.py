@@ -1,17 +1,140 @@
 #!/usr/bin/env python3
 
 import argparse
-import collections
+import atexit
+import collections.abc
+import concurrent.futures
+import io
 import json
 import re
 import os
 import sys
+import threading
 import time
+import urllib.parse
 
-import urllib.request
-import xml.etree.ElementTree as ET
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+try:
+    import lxml.etree as ET
+    HAVE_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    HAVE_LXML = False
+
+try:
+    import orjson
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
 
 KEY_FIELD_NAME = '0KEY_'
+CLEANED_FIELD_NAME = '_cleaned'
+SCHEMA_FIELD_NAME = '_schema'
+VALIDATORS_FIELD_NAME = '_http'
+CACHE_META_FIELDS = { KEY_FIELD_NAME, CLEANED_FIELD_NAME, SCHEMA_FIELD_NAME,
+                      VALIDATORS_FIELD_NAME }
+# Bump whenever clean_raw_metadata_* output changes, so that cached cleaned
+# metadata gets recomputed
+CACHE_SCHEMA = 2
+MAX_WORKERS = 8
+
+# Number of concurrent requests allowed per source (arXiv OAI-PMH and the
+# Crossref public pool ask for one request at a time, Semantic Scholar
+# tolerates a few)
+HOST_SEMAPHORES = {
+    'a': threading.Semaphore(1),
+    'd': threading.Semaphore(1),
+    's': threading.Semaphore(3),
+}
+
+# No mailto contact is sent, so Crossref serves requests from its public
+# (not polite) pool and limits below stay within the public pool's
+USER_AGENT = 'awesome-iml-readme-gen ' \
+    '(https://github.com/lopusz/awesome-interpretable-machine-learning)'
+HTTP_TIMEOUT = 30
+
+# Minimal interval (in seconds) between consecutive requests to a host
+HOST_MIN_INTERVALS = {
+    'export.arxiv.org': 3,
+    'api.crossref.org': 0.2,
+    'api.semanticscholar.org': 1,
+}
+
+# New cache entries are appended as soon as they are fetched; the whole file
+# is rewritten (deduplicated and sorted) every CACHE_COMPACT_EVERY entries
+# and at exit
+CACHE_COMPACT_EVERY = 25
+CACHE_LOCK = threading.Lock()
+_dirty_count = 0
+
+
+class RateLimiter:
+
+    def __init__(self, min_intervals, default_interval=0):
+        self._min_intervals = min_intervals
+        self._default_interval = default_interval
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host):
+        # Reserve the next free slot for the host, then sleep until it comes
+        interval = self._min_intervals.get(host, self._default_interval)
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def make_session():
+    # Keep-alive connections are reused across all fetches; throttling and
+    # transient server errors are retried with exponential backoff, honoring
+    # Retry-After (no backoff_jitter, it needs urllib3 2.x)
+    retry = urllib3.util.retry.Retry(total=5, backoff_factor=2,
+                                     status_forcelist=[429, 500, 502, 503, 504])
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4,
+                                            pool_maxsize=16,
+                                            max_retries=retry)
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+SESSION = make_session()
+RATE_LIMITER = RateLimiter(HOST_MIN_INTERVALS)
+
+
+def http_get(url, validators=None):
+    # With validators of a cached response the request is conditional, and
+    # the server answers 304 if the resource has not changed since
+    headers = {}
+    if validators is not None:
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last_modified' in validators:
+            headers['If-Modified-Since'] = validators['last_modified']
+    RATE_LIMITER.acquire(urllib.parse.urlsplit(url).hostname)
+    response = SESSION.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    return response
+
+
+def set_http_validators(res, response):
+    validators = {}
+    if 'ETag' in response.headers:
+        validators['etag'] = response.headers['ETag']
+    if 'Last-Modified' in response.headers:
+        validators['last_modified'] = response.headers['Last-Modified']
+    if validators:
+        res[VALIDATORS_FIELD_NAME] = validators
+    return res
+
 
 def parse_argv(argv):
     parser = argparse.ArgumentParser()
@@ -19,40 +142,186 @@ def parse_argv(argv):
                         action='store', required=True)
     parser.add_argument('--cache-fname', dest='cache_fname',
                         action='store', required=False, default=None)
+    parser.add_argument('--refresh', dest='refresh',
+                        action='store_true', default=False,
+                        help='revalidate cached entries with the servers')
     return parser.parse_args(argv)
 
 
+def dumps_cache_record(record):
+    if HAVE_ORJSON:
+        return orjson.dumps(record, option=orjson.OPT_SORT_KEYS) + b'\n'
+    # Same bytes as orjson, so the tracked cache file does not depend on
+    # whether orjson is installed
+    return (json.dumps(record, sort_keys=True, separators=(',', ':'),
+                       ensure_ascii=False)+'\n').encode('utf-8')
+
+
+def loads_cache_record(line):
+    if HAVE_ORJSON:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+# Records are saved with sorted keys, so the key field comes first
+_CACHE_KEY_RE = re.compile(rb'^\{"' + KEY_FIELD_NAME.encode('utf-8')
+                           + rb'": ?"([^"\\]*)"')
+
+
+def read_cache_record_key(line):
+    match = _CACHE_KEY_RE.match(line)
+    if match is not None:
+        return match.group(1).decode('utf-8')
+    return loads_cache_record(line)[KEY_FIELD_NAME]
+
+
+def _is_cache_record(line):
+    try:
+        return KEY_FIELD_NAME in loads_cache_record(line)
+    except ValueError:
+        return False
+
+
+class LazyCache(collections.abc.MutableMapping):
+    # Only keys and file offsets of records are read upfront, a record is
+    # parsed when first accessed. Once all of them are, it is a plain dict.
+
+    def __init__(self, cache_fname):
+        self._cache_fname = cache_fname
+        self._offsets = {}
+        self._records = {}
+        self._lock = threading.Lock()
+        truncate_offset = None
+        with open(cache_fname, 'rb') as f:
+            offset = 0
+            for line in f:
+                if not line.endswith(b'\n') and not _is_cache_record(line):
+                    # Partial record left by an interrupted append
+                    truncate_offset = offset
+                    break
+                # Entries cached before key normalization are re-keyed
+                key = normalize_cache_key(read_cache_record_key(line))
+                self._offsets[key] = offset
+                offset += len(line)
+        if truncate_offset is not None:
+            print('Dropping partial last record of %s' % cache_fname,
+                  file=sys.stderr)
+            os.truncate(cache_fname, truncate_offset)
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key not in self._records:
+                offset = self._offsets.pop(key)
+                with open(self._cache_fname, 'rb') as f:
+                    f.seek(offset)
+                    line = f.readline()
+                try:
+                    r = loads_cache_record(line)
+                except ValueError:
+                    # Corrupted record is dropped, it gets fetched again
+                    print('Dropping corrupted record %s' % key,
+                          file=sys.stderr)
+                    raise KeyError(key)
+                r[KEY_FIELD_NAME] = key
+                self._records[key] = r
+            return self._records[key]
+
+    def __setitem__(self, key, record):
+        with self._lock:
+            self._offsets.pop(key, None)
+            self._records[key] = record
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key in self._offsets:
+                del self._offsets[key]
+            else:
+                del self._records[key]
+
+    def __iter__(self):
+        with self._lock:
+            keys = list(self._records) + list(self._offsets)
+        return iter(keys)
+
+    def __len__(self):
+        return len(self._records) + len(self._offsets)
+
+    def __contains__(self, key):
+        return key in self._records or key in self._offsets
+
+
 def load_cache(cache_fname):
-    cache = {}
+    # Appended entries may duplicate earlier ones, the last one wins
     if os.path.isfile(cache_fname):
-        with open(cache_fname, 'rt') as f:
-            for line in f:
-                r = json.loads(line)
-                key = r[KEY_FIELD_NAME]
-                cache[key] = r
-    return cache
+        return LazyCache(cache_fname)
+    return {}
 
 
 def save_cache(cache_fname, cache):
-
-    with open(cache_fname, 'wt') as f:
+    # Written aside and renamed, so an interrupted save leaves the old cache
+    tmp_fname = cache_fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
         for k in sorted(cache.keys()):
-            f.write(json.dumps(cache[k], sort_keys=True)+'\n')
+            r = cache.get(k, None)
+            if r is not None:
+                f.write(dumps_cache_record(r))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, cache_fname)
+
+
+def _append_cache(cache_fname, record):
+    with open(cache_fname, 'a+b') as f:
+        # Never glue a record onto a line left unterminated by a crash
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+        f.write(dumps_cache_record(record))
+
+
+def _update_cache(cache_fname, cache, record):
+    global _dirty_count
+
+    with CACHE_LOCK:
+        cache[record[KEY_FIELD_NAME]] = record
+        if cache_fname is not None:
+            _append_cache(cache_fname, record)
+            _dirty_count += 1
+            if _dirty_count >= CACHE_COMPACT_EVERY:
+                save_cache(cache_fname, cache)
+                _dirty_count = 0
+
+
+def _compact_cache(cache_fname, cache):
+    global _dirty_count
+
+    with CACHE_LOCK:
+        if _dirty_count > 0:
+            save_cache(cache_fname, cache)
+            _dirty_count = 0
 
 
 def extract_metadata(line):
-    ENUMERATION_CHARS = { '+' }
+    ENUMERATION_CHARS = ( '+', )
+    INDENTATION_CHARS = ( ' ', '\t' )
     BEG_REFERENCE_CHAR = '{'
     END_REFERENCE_CHAR = '}'
 
     def _get_line_prefix(line, enumerator_char):
         return line.split(sep=enumerator_char, maxsplit=1)[0]
 
+    # Called for every template line, so lines that cannot hold a reference
+    # are rejected before anything gets allocated
+    if not line.startswith(ENUMERATION_CHARS + INDENTATION_CHARS):
+        return None
+
     res = None
     line_stripped = line.strip()
-    if line_stripped and line_stripped[0] in ENUMERATION_CHARS:
+    if line_stripped.startswith(ENUMERATION_CHARS):
         line_reference = line_stripped[1:].strip()
-        if (line_reference[0] == BEG_REFERENCE_CHAR and line_reference[-1] == END_REFERENCE_CHAR):
+        if (line_reference.startswith(BEG_REFERENCE_CHAR)
+                and line_reference.endswith(END_REFERENCE_CHAR)):
             enumerator_char = line_stripped[0]
             res = json.loads(line_reference)
             res['enumerator_char'] = enumerator_char
@@ -60,94 +329,129 @@ def extract_metadata(line):
     return res
 
 
-def get_cache_key(src_code, src_id):
-    return  src_code + ':' + src_id
+_ARXIV_PREFIX_RE = re.compile(r'^arxiv:', re.IGNORECASE)
 
 
-def parse_generic_xml(root):
+def normalize_src_id(src_code, src_id):
+    src_id = src_id.strip()
+    if src_code == 'a':
+        src_id = _ARXIV_PREFIX_RE.sub('', src_id)
+    elif src_code == 'd':
+        # DOIs are case insensitive
+        src_id = src_id.lower()
+    return src_id
 
-    ATTRIB_KEY = '_attrib'
 
-    def _normalize_tag(s):
-        i = s.rfind('}')
-        return s[(i+1):]
+def get_cache_key(src_code, src_id):
+    return  src_code + ':' + normalize_src_id(src_code, src_id)
 
-    def _insert_and_listify(res, key, val):
 
-        if key in res:
-            val_cur = res[key]
-            if isinstance(val_cur, list):
-                res[key].append(val)
-            else:
-                res[key] = [val_cur] + [val]
-        else:
-            res[key] = val
-        return res
-
-    res = {}
-
-    for child in root:
-        if len(child) > 0:
-            key = _normalize_tag(child.tag)
-            val = parse_generic_xml(child)
-            if len(child.attrib) > 0:
-                val[ATTRIB_KEY] = child.attrib
-            res = _insert_and_listify(res, key, val)
-        else:
-            key = _normalize_tag(child.tag)
-            val = child.text
-            if len(child.attrib) > 0:
-                val_new = { 'val': val, ATTRIB_KEY: child.attrib }
-                val = val_new
-            res = _insert_and_listify(res, key, val)
-    return res
+def normalize_cache_key(cache_key):
+    src_code, src_id = cache_key.split(':', 1)
+    return get_cache_key(src_code, src_id)
+
+
+def iterparse_xml(data, events=('end',)):
+    source = io.BytesIO(data)
+    if HAVE_LXML:
+        return ET.iterparse(source, events=events,
+                            huge_tree=False, resolve_entities=False)
+    return ET.iterparse(source, events=events)
 
 
-def fetch_raw_metadata_arxiv(src_id):
+def fetch_raw_metadata_arxiv(src_id, validators=None):
     OAI_PMH_URL = 'http://export.arxiv.org/oai2'
     QUERY_FORMAT = '?verb=GetRecord&identifier=oai:arXiv.org:%s&metadataPrefix=arXiv'
 
-    query = QUERY_FORMAT % src_id
-    finished = False
-    while not finished:
-        try:
-            url = OAI_PMH_URL + query
-            #print('Fetching %s' % url, file=sys.stderr)
-            result = urllib.request.urlopen(url).read()
-            time.sleep(5)
-            finished = True
-        except urllib.error.HTTPError as e:
-            if e.code == 503:
-                retry_after = int(e.headers['Retry-After'])
-                print('Sleeping %d...' % retry_after, file=sys.stderr)
-                time.sleep(retry_after)
-            else:
-                raise e
-    res=parse_generic_xml(ET.fromstring(result))
-    return res
+    url = OAI_PMH_URL + QUERY_FORMAT % src_id
+    #print('Fetching %s' % url, file=sys.stderr)
+    response = http_get(url, validators)
+    if response.status_code == 304:
+        return None
+    # Response is reduced to the cleaned metadata right away, so the cache
+    # holds it post-clean
+    res = clean_raw_metadata_arxiv_fast(response.content)
+    return set_http_validators(res, response)
 
 
-def clean_raw_metadata_arxiv(met_raw):
+_WS_RE = re.compile(r' +')
 
-    def _normalize_title(title):
-        title_norm = title.replace('\n', ' ')
-        title_norm = re.sub(r' +', ' ', title_norm)
-        return title_norm
 
+def _normalize_arxiv_title(title):
+    return _WS_RE.sub(' ', title.replace('\n', ' '))
+
+
+def _normalize_arxiv_id(arxiv_id):
+    return arxiv_id.replace('oai:arXiv.org:', '')
+
+
+def clean_raw_metadata_arxiv_fast(xml_bytes):
+    OAI_NS = '{http://www.openarchives.org/OAI/2.0/}'
+    ARXIV_NS = '{http://arxiv.org/OAI/arXiv/}'
+
+    # Response is streamed, only the needed values are kept and every
+    # processed element is freed right away
+    values = {}
+    authors = []
+    found = False
+    author_depth = 0
+    for event, elem in iterparse_xml(xml_bytes, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            if tag == ARXIV_NS + 'author' or author_depth > 0:
+                author_depth += 1
+            continue
+        if author_depth > 0:
+            author_depth -= 1
+            if author_depth > 0:
+                # Children of author (keyname, forenames, suffix,
+                # affiliation) are read and freed along with it
+                continue
+        if tag == ARXIV_NS + 'author':
+            authors.append([ elem.findtext(ARXIV_NS + 'keyname'),
+                             elem.findtext(ARXIV_NS + 'forenames', default='') ])
+        elif tag == ARXIV_NS + 'arXiv':
+            found = True
+        elif tag in (ARXIV_NS + 'title', ARXIV_NS + 'created',
+                     ARXIV_NS + 'doi', OAI_NS + 'identifier'):
+            values.setdefault(tag, elem.text)
+        elem.clear()
+        if HAVE_LXML:
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+    if not found:
+        raise ValueError('No arXiv record in OAI-PMH response')
+
+    met = {}
+    met['title'] = _normalize_arxiv_title(values[ARXIV_NS + 'title'])
+    met['authors'] = authors
+    met['arxiv_id'] = _normalize_arxiv_id(values[OAI_NS + 'identifier'])
+    created = values.get(ARXIV_NS + 'created', None)
+    if created is not None:
+        met['year'] = created[0:4]
+    met['doi'] = values.get(ARXIV_NS + 'doi', None)
+    return met
+
+
+def clean_raw_metadata_arxiv(met_raw):
 
     def _normalize_authors(authors):
         return [ [ a['keyname'], a['forenames'] ] for a in authors ]
 
+    if 'GetRecord' not in met_raw:
+        # Already cleaned by clean_raw_metadata_arxiv_fast
+        return { k: v for k, v in met_raw.items() if k not in CACHE_META_FIELDS }
 
-    def _normalize_arxiv_id(arxiv_id):
-        return arxiv_id.replace('oai:arXiv.org:', '')
-
+    # Entries cached before clean_raw_metadata_arxiv_fast hold the whole
+    # OAI-PMH response converted to nested dicts
     met = {}
     title_raw = met_raw['GetRecord']['record']['metadata']['arXiv']['title']
     authors_raw = met_raw['GetRecord']['record']['metadata']['arXiv']['authors']['author']
-    if not isinstance(authors_raw, collections.Sequence):
+    if isinstance(authors_raw, dict):
+        # Single author is not wrapped in a list
         authors_raw = [ authors_raw ]
-    met['title'] = _normalize_title(title_raw)
+    met['title'] = _normalize_arxiv_title(title_raw)
     met['authors'] = _normalize_authors(authors_raw)
     arxiv_id_raw = met_raw['GetRecord']['record']['header']['identifier']
     met['arxiv_id'] = _normalize_arxiv_id(arxiv_id_raw)
@@ -163,15 +467,15 @@ def clean_raw_metadata_arxiv(met_raw):
     return met
 
 
-def fetch_raw_metadata_doi(src_id):
+def fetch_raw_metadata_doi(src_id, validators=None):
     CROSSREF_API_URL = 'http://api.crossref.org/works/'
 
     url = CROSSREF_API_URL + src_id
     #print('Fetching %s' % url, file=sys.stderr)
-    result = urllib.request.urlopen(url).read()
-    time.sleep(5)
-    finished = True
-    return json.loads(result.decode('utf-8'))
+    response = http_get(url, validators)
+    if response.status_code == 304:
+        return None
+    return set_http_validators(response.json(), response)
 
 
 def clean_raw_metadata_doi(met_raw):
@@ -179,30 +483,28 @@ def clean_raw_metadata_doi(met_raw):
 
     met = {}
 
-    title=''
-    for t in title_parts:
-        title += ' ' + t
-
     authors  =[ [ a['family'], a['given'] ]  for a in met_raw['message']['author'] ]
 
-    met['title'] = title[1:]
+    met['title'] = ' '.join(title_parts)
     met['authors'] = authors
     met['doi'] =  met_raw['message']['DOI']
     met['year'] = str(met_raw['message']['created']['date-parts'][0][0])
     return met
 
 
-def fetch_raw_metadata_sems(src_id):
-    SEMS_API_URL = 'http://api.semanticscholar.org/v1/paper/'
+def fetch_raw_metadata_sems(src_id, validators=None):
+    SEMS_API_URL = 'https://api.semanticscholar.org/graph/v1/paper/'
+    # Only fields used by clean_raw_metadata_sems are requested
+    SEMS_FIELDS = 'title,authors,externalIds,year'
 
-    url = SEMS_API_URL + src_id
+    url = SEMS_API_URL + src_id + '?fields=' + SEMS_FIELDS
     #print('Fetching %s' % url, file=sys.stderr)
-    result = urllib.request.urlopen(url).read()
-    time.sleep(5)
-    finished = True
-    res = json.loads(result.decode('utf-8'))
+    response = http_get(url, validators)
+    if response.status_code == 304:
+        return None
+    res = response.json()
     res['sems_id'] = src_id
-    return res
+    return set_http_validators(res, response)
 
 
 def clean_raw_metadata_sems(met_raw):
@@ -217,11 +519,17 @@ def clean_raw_metadata_sems(met_raw):
     met['title'] = met_raw['title']
     met['sems_id'] = met_raw['sems_id']
 
-    if 'arxivId' in met_raw:
-        met['arxiv_id'] = met_raw['arxivId']
-    if 'doi' in met_raw:
-        met['doi'] = met_raw['doi']
-    if 'year' in met_raw:
+    if 'externalIds' in met_raw:
+        external_ids = met_raw['externalIds'] or {}
+        met['arxiv_id'] = external_ids.get('ArXiv', None)
+        met['doi'] = external_ids.get('DOI', None)
+    else:
+        # Entries cached from the former v1 API
+        if 'arxivId' in met_raw:
+            met['arxiv_id'] = met_raw['arxivId']
+        if 'doi' in met_raw:
+            met['doi'] = met_raw['doi']
+    if met_raw.get('year', None) is not None:
         met['year'] = str(met_raw['year'])
     return met
 
@@ -237,35 +545,55 @@ def convert_metadata_to_lines(m):
         year = ' (' + year + ') '
     else:
         year = ' '
-    content = m['line_prefix'] + m['enumerator_char'] + year \
-              + m['title']
-    authors = ''
-
-    for a in m['authors']:
-        authors += ', ' + a[1] + ' ' + a[0]
-    content += ' by ' + authors[2:] + '\n'
+    authors = ', '.join(a[1] + ' ' + a[0] for a in m['authors'])
+    content_parts = [ m['line_prefix'], m['enumerator_char'], year,
+                      m['title'], ' by ', authors, '\n' ]
     prefix =  m['line_prefix'] + '  '  + m['enumerator_char'] + ' '
     arxiv_id = m.get('arxiv_id', None)
     if arxiv_id is not None:
-        content += prefix + 'https://arxiv.org/pdf/' + arxiv_id + '\n'
+        content_parts += [ prefix, 'https://arxiv.org/pdf/', arxiv_id, '\n' ]
     doi = m.get('doi', None)
     if doi is not None and not m.get('skip_doi', False):
-        content += prefix + 'https://dx.doi.org/' + doi + '\n'
-    return content
+        content_parts += [ prefix, 'https://dx.doi.org/', doi, '\n' ]
+    return ''.join(content_parts)
 
 
-def fetch_metadata_cached(src_code, src_id, cache, fetch_raw, clean_raw):
+def fetch_metadata_cached(src_code, src_id, cache, fetch_raw, clean_raw,
+                          cache_fname=None, refresh=False):
     cache_key = get_cache_key(src_code, src_id)
     met_raw = cache.get(cache_key, None)
 
-    if met_raw is None:
-        met_raw = fetch_raw(src_id)
-        met_raw[KEY_FIELD_NAME] = cache_key
-        cache[cache_key] = met_raw
+    if met_raw is None or refresh:
+        validators = None
+        if met_raw is not None:
+            validators = met_raw.get(VALIDATORS_FIELD_NAME, None)
+        with HOST_SEMAPHORES[src_code]:
+            met_fetched = fetch_raw(src_id, validators)
+        # None means the cached record is still up to date
+        if met_fetched is not None:
+            met_raw = met_fetched
+            met_raw[KEY_FIELD_NAME] = cache_key
+
+    if met_raw.get(SCHEMA_FIELD_NAME, None) == CACHE_SCHEMA:
+        return met_raw[CLEANED_FIELD_NAME]
+
+    # Store cleaned metadata along with the raw one, so that cache hits skip
+    # clean_raw. Record is copied as the cached one may be being saved.
     met = clean_raw(met_raw)
+    met_raw = dict(met_raw)
+    met_raw[CLEANED_FIELD_NAME] = met
+    met_raw[SCHEMA_FIELD_NAME] = CACHE_SCHEMA
+    _update_cache(cache_fname, cache, met_raw)
     return met
 
 
+SOURCES = [
+    ('arxiv_id', 'a', fetch_raw_metadata_arxiv, clean_raw_metadata_arxiv),
+    ('doi', 'd', fetch_raw_metadata_doi, clean_raw_metadata_doi),
+    ('sems_id', 's', fetch_raw_metadata_sems, clean_raw_metadata_sems),
+]
+
+
 def main(args):
 
     def merge_dicts(m1, m2):
@@ -277,45 +605,52 @@ def main(args):
     cache = {}
     if args.cache_fname is not None:
         cache = load_cache(args.cache_fname)
-    n0_cache = len(cache)
+        atexit.register(_compact_cache, args.cache_fname, cache)
 
+    # Parse phase - collect all references from the template
     with open(args.readme_template, 'r') as f:
-        for line in f:
-
-            m = extract_metadata(line)
-            m_arx, m_doi, m_sems = {}, {}, {}
-
-            if m is not None:
-                if 'arxiv_id' in m:
-                    m_arx = fetch_metadata_cached(
-                                src_code='a', src_id=m['arxiv_id'],
-                                fetch_raw=fetch_raw_metadata_arxiv,
-                                clean_raw=clean_raw_metadata_arxiv,
-                                cache=cache)
-                if 'doi' in m:
-                    m_doi = fetch_metadata_cached(
-                                src_code='d', src_id=m['doi'],
-                                fetch_raw=fetch_raw_metadata_doi,
-                                clean_raw=clean_raw_metadata_doi,
-                                cache=cache)
-                if 'sems_id' in m:
-                    m_sems = fetch_metadata_cached(
-                                src_code='s', src_id=m['sems_id'],
-                                fetch_raw=fetch_raw_metadata_sems,
-                                clean_raw=clean_raw_metadata_sems,
-                                cache=cache)
-
-                m = merge_dicts(m, m_arx)
-                m = merge_dicts(m, m_doi)
-                m = merge_dicts(m, m_sems)
-
-                lines = convert_metadata_to_lines(m)
-                print(lines, end='', flush=True)
-            else:
-                print(line, end='', flush=True)
-
-    if args.cache_fname is not None and n0_cache != len(cache):
-        save_cache(args.cache_fname, cache)
+        template_lines = f.readlines()
+
+    # Identical references are collected once (dict keeps template order)
+    entries = {}
+    unique = {}
+    for line_idx, line in enumerate(template_lines):
+        m = extract_metadata(line)
+        if m is not None:
+            line_refs = []
+            for field, src_code, _, _ in SOURCES:
+                if field in m:
+                    ref = (src_code, normalize_src_id(src_code, m[field]))
+                    line_refs.append(ref)
+                    unique[ref] = None
+            entries[line_idx] = (m, line_refs)
+
+    # Fetch phase - one request per distinct reference, run concurrently
+    fetchers = { src_code: (fetch_raw, clean_raw)
+                 for _, src_code, fetch_raw, clean_raw in SOURCES }
+    futures = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for src_code, src_id in unique:
+            fetch_raw, clean_raw = fetchers[src_code]
+            futures[(src_code, src_id)] = executor.submit(
+                fetch_metadata_cached,
+                src_code=src_code, src_id=src_id,
+                fetch_raw=fetch_raw, clean_raw=clean_raw,
+                cache=cache, cache_fname=args.cache_fname,
+                refresh=args.refresh)
+    mets = { k: f.result() for k, f in futures.items() }
+
+    # Render phase - splice fetched metadata into the template lines
+    results = {}
+    for line_idx, (m, line_refs) in entries.items():
+        for ref in line_refs:
+            m = merge_dicts(m, mets[ref])
+        results[line_idx] = convert_metadata_to_lines(m)
+
+    # Emit phase - output is written in one go, once everything is fetched
+    for line_idx, line in enumerate(template_lines):
+        sys.stdout.write(results.get(line_idx, line))
+    sys.stdout.flush()
 
 
 if __name__ == '__main__':